@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 import re
-from datetime import datetime
+from datetime import datetime, timezone
 from instagrapi import Client
 from instagrapi.exceptions import (
     BadPassword,
@@ -14,14 +14,49 @@ from instagrapi.exceptions import (
     SelectContactPointRecoveryForm,
     UserNotFound,
 )
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from loguru import logger
+import orjson
+from collections import defaultdict, deque
+from contextlib import closing
+import calendar
+import csv
+import io
 import os
+import shutil
+import subprocess
+import tempfile
 import time
-import random
+import sqlite3
+import threading
 
 # Constants
 SESSION_DURATION = 86400  # 24 hours in seconds
 LOG_FILE = "app.log"
+CACHE_DB = "cache.db"
+USER_ID_TTL = 30 * 86400  # Username -> user ID mappings rarely change
+CURRENT_MONTH_TTL = 86400  # Months that can still gain posts; finished months never expire
+MAX_WORKERS = 4  # Concurrent usernames; keep low to stay under Instagram's rate limits
+REQUESTS_PER_SECOND = 1.0  # Sustained rate per Instagram endpoint, shared by all workers
+REQUEST_BURST = 2  # Calls allowed back-to-back before the rate applies
+MEDIA_PAGE_SIZE = 50  # Medias requested per page
+MAX_MEDIAS = 1000  # Upper bound on medias fetched per user
+STATUS_LINES = 20  # Recent progress messages kept in the status panel
+CSV_FIELDS = ["Instagram ID", "Post Count", "Year", "Month", "Links"]
+MAX_DISPLAY_ROWS = 1000  # Rows rendered in the results table; the CSV download has everything
+
+# Precompiled lookups
+# Profile URLs, "IG:" handles and bare usernames, matched in a single scan.
+# Handles and bare tokens never start a token that contains a profile URL, so the URL branch wins.
+# A handle must end its token (trailing slashes allowed), so "IG: https://..." isn't read as "https".
+_EXTRACT_RE = re.compile(
+    r"instagram\.com/([^/?\s]+)"
+    r"|IG:\s*(?!\S*instagram\.com)([\w.]+)(?=/*(?!\S))"
+    r"|(?<!\S)(?!\S*instagram\.com)([\w.]+)(?!\S)"
+)
+_LOG_FILTER_RE = re.compile(r"Completed|Error")
+_MONTHS = {calendar.month_name[i]: i for i in range(1, 13)}
 
 # Configure Loguru
 logger.add(LOG_FILE, rotation="10 MB")
@@ -88,101 +123,244 @@ class Account:
         duration = hours * 3600 + days * 86400
         logger.warning(f"Account frozen: {message} for {duration} seconds")
 
+# Token bucket shared by worker threads; only sleeps once the endpoint budget is spent
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 0
+                self.updated = time.monotonic()
+            else:
+                self.tokens -= 1
+
+# Single placeholder showing the latest progress lines, so updates replace one element instead of appending many
+class StatusPanel:
+    def __init__(self, max_lines=STATUS_LINES):
+        self.placeholder = st.empty()
+        self.lines = deque(maxlen=max_lines)
+        self.lock = threading.Lock()
+
+    def add(self, messages):
+        with self.lock:
+            self.lines.extend(messages)
+            self.placeholder.markdown("\n\n".join(self.lines))
+
+# One bucket per endpoint, as Instagram limits each endpoint separately
+user_id_bucket = TokenBucket(REQUESTS_PER_SECOND, REQUEST_BURST)
+user_medias_bucket = TokenBucket(REQUESTS_PER_SECOND, REQUEST_BURST)
+
 # Helper Functions
+def load_session(client, session_file):
+    # Same as Client.load_settings, parsed with orjson instead of json
+    with open(session_file, "rb") as file:
+        client.set_settings(orjson.loads(file.read()))
+
+def save_session(client, session_file):
+    with open(session_file, "wb") as file:
+        file.write(orjson.dumps(client.get_settings(), option=orjson.OPT_INDENT_2))
+
+def session_age(session_file):
+    """Seconds since the session file was written, or None if it doesn't exist."""
+    try:
+        return time.time() - os.stat(session_file).st_mtime
+    except FileNotFoundError:
+        return None
+
+@st.cache_data(ttl=5)
 def is_session_valid(session_file):
-    if os.path.exists(session_file):
-        file_age = time.time() - os.path.getmtime(session_file)
-        if file_age < SESSION_DURATION:
-            return True
-    return False
-
-def extract_ig_username(url):
-    if isinstance(url, str):
-        match = re.search(r"instagram\.com/([^/?]+)", url)
-        return match.group(1) if match else None
-    return None
+    file_age = session_age(session_file)
+    return file_age is not None and file_age < SESSION_DURATION
 
 def extract_ig_usernames(text):
-    lines = text.splitlines()
-    usernames = []
-    for line in lines:
-        parts = line.split()
-        for part in parts:
-            if 'instagram.com' in part:
-                username = extract_ig_username(part)
-                if username:
-                    usernames.append(username)
-            elif 'IG:' in part:
-                username = part.split('IG:')[-1].strip().replace('/', '')
-                if username:
-                    usernames.append(username)
-            elif re.match(r'^[\w.]+$', part.strip()):  # For simple usernames not part of a URL
-                usernames.append(part.strip())
-    return list(filter(None, usernames))
-
-def count_posts_for_month(user_id, year, month, client):
-    posts = client.user_medias(user_id, amount=1000)
-    start_date = datetime(year, month, 1)
-    end_date = datetime(year, month + 1, 1) if month < 12 else datetime(year + 1, 1, 1)
-    count = 0
-    links = []
+    return [match.group(match.lastindex) for match in _EXTRACT_RE.finditer(text)]
+
+# Reruns from unrelated widgets reuse the parse of an unchanged text area
+@st.cache_data(max_entries=16)
+def extract_ig_usernames_cached(text):
+    return extract_ig_usernames(text)
+
+def group_posts_by_month(posts):
+    """Bucket post shortcodes by (year, month) in a single pass."""
+    buckets = defaultdict(list)
     for post in posts:
-        post_date = post.taken_at.replace(tzinfo=None) if post.taken_at.tzinfo else post.taken_at
-        if start_date <= post_date < end_date:
-            count += 1
-            links.append(f"https://www.instagram.com/p/{post.code}/")
-    return count, links
+        # Year and month read the same with or without tzinfo, so no per-post conversion is needed
+        taken_at = post.taken_at
+        buckets[(taken_at.year, taken_at.month)].append(post.code)
+    return buckets
+
+def fetch_medias_since(client, user_id, start_year, start_month):
+    """Page through medias newest-first, stopping once a page reaches back before the start month.
+
+    Returns the medias and whether every post since the start month was fetched;
+    this is False when the MAX_MEDIAS cap was hit first.
+    """
+    medias = []
+    end_cursor = ""
+    while len(medias) < MAX_MEDIAS:
+        user_medias_bucket.take()
+        page, end_cursor = client.user_medias_paginated(user_id, MEDIA_PAGE_SIZE, end_cursor=end_cursor)
+        medias.extend(page)
+        if not page or not end_cursor:
+            return medias, True
+        # Pinned posts sit out of order at the top, so judge by the oldest end of the page
+        oldest = page[-1].taken_at
+        if (oldest.year, oldest.month) < (start_year, start_month):
+            return medias, True
+    return medias, False
+
+# Cache Helpers
+def get_cache_connection():
+    conn = sqlite3.connect(CACHE_DB, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS user_ids (username TEXT PRIMARY KEY, user_id TEXT, fetched_at INTEGER)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS monthly (user_id TEXT, year INT, month INT, count INT, links TEXT, fetched_at INTEGER, "
+        "PRIMARY KEY (user_id, year, month))"
+    )
+    return conn
+
+def cached_user_id(username, client):
+    with closing(get_cache_connection()) as conn:
+        row = conn.execute("SELECT user_id, fetched_at FROM user_ids WHERE username = ?", (username,)).fetchone()
+        if row and time.time() - row[1] < USER_ID_TTL:
+            return row[0]
+        user_id_bucket.take()
+        user_id = client.user_id_from_username(username)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO user_ids VALUES (?, ?, ?)", (username, user_id, int(time.time())))
+        return user_id
+
+def is_month_final(year, month, fetched_at):
+    """A month fetched after it ended can no longer change."""
+    next_month = datetime(year + month // 12, month % 12 + 1, 1)
+    return datetime.fromtimestamp(fetched_at, timezone.utc).replace(tzinfo=None) >= next_month
+
+def load_cached_months(user_id, months):
+    """Return {(year, month): (count, links)} if every month is cached and fresh, else None."""
+    now = time.time()
+    with closing(get_cache_connection()) as conn:
+        rows = conn.execute("SELECT year, month, count, links, fetched_at FROM monthly WHERE user_id = ?", (user_id,)).fetchall()
+    cached = {
+        (year, month): (count, links)
+        for year, month, count, links, fetched_at in rows
+        if is_month_final(year, month, fetched_at) or now - fetched_at < CURRENT_MONTH_TTL
+    }
+    if all(month in cached for month in months):
+        return cached
+    return None
 
-def manual_search(username, start_year, start_month, end_year, end_month, client):
+def save_cached_months(user_id, month_counts):
+    fetched_at = int(time.time())
+    with closing(get_cache_connection()) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO monthly VALUES (?, ?, ?, ?, ?, ?)",
+            [(user_id, year, month, count, links, fetched_at) for (year, month), (count, links) in month_counts.items()],
+        )
+
+def error_row(username, message):
+    return {
+        "Instagram ID": username,
+        "Post Count": 0,
+        "Year": "-",
+        "Month": "-",
+        "Links": message
+    }
+
+def manual_search(username, start_year, start_month, end_year, end_month, client, status_panel):
     all_posts = []
+    completion_messages = []
     try:
-        user_id = client.user_id_from_username(username)
-        for year in range(start_year, end_year + 1):
-            for month in range(start_month if year == start_year else 1, end_month + 1 if year == end_year else 13):
-                start_time = time.time()
-                post_count, post_links = count_posts_for_month(user_id, year, month, client)
-                month_name = datetime(year, month, 1).strftime('%B')
-                all_posts.append({
-                    "Instagram ID": username,
-                    "Post Count": post_count,
-                    "Year": str(year),  # Ensure the year is stored as a string
-                    "Month": month_name if month_name else "-",
-                    "Links": " | ".join(post_links)
+        user_id = cached_user_id(username, client)
+        months = [
+            (year, month)
+            for year in range(start_year, end_year + 1)
+            for month in range(start_month if year == start_year else 1, end_month + 1 if year == end_year else 13)
+        ]
+        start_time = time.time()
+        month_counts = load_cached_months(user_id, months)
+        if month_counts is None:
+            # One paged fetch per user; every month in the range is answered from it
+            posts, complete = fetch_medias_since(client, user_id, start_year, start_month)
+            posts_by_month = group_posts_by_month(posts)
+            month_counts = {}
+            for month_key in months:
+                post_codes = posts_by_month.get(month_key, [])
+                post_links = " | ".join("https://www.instagram.com/p/" + code + "/" for code in post_codes)
+                month_counts[month_key] = (len(post_codes), post_links)
+            if complete:
+                save_cached_months(user_id, month_counts)
+            else:
+                # The cap cut the fetch short; only months newer than the oldest fetched post are complete
+                oldest = posts[-1].taken_at
+                save_cached_months(user_id, {
+                    month_key: counts for month_key, counts in month_counts.items()
+                    if month_key > (oldest.year, oldest.month)
                 })
-                elapsed_time = time.time() - start_time
-                completion_message = f"Completed {username} | {month_name} {year} | Posts: {post_count} | Time: {elapsed_time:.2f} sec"
-                st.write(completion_message)
-                logger.info(completion_message)
-                time.sleep(random.uniform(0.5, 1.5))
+        elapsed_time = time.time() - start_time
+        for year, month in months:
+            post_count, post_links = month_counts[(year, month)]
+            month_name = calendar.month_name[month]
+            all_posts.append({
+                "Instagram ID": username,
+                "Post Count": post_count,
+                "Year": str(year),  # Ensure the year is stored as a string
+                "Month": month_name if month_name else "-",
+                "Links": post_links
+            })
+            completion_message = f"Completed {username} | {month_name} {year} | Posts: {post_count}"
+            completion_messages.append(completion_message)
+            logger.info(completion_message)
+        completion_message = f"Completed {username} | {len(months)} months | Time: {elapsed_time:.2f} sec"
+        completion_messages.append(completion_message)
+        logger.info(completion_message)
+        status_panel.add(completion_messages)
     except UserNotFound:
         error_message = f"Error: User {username} not found."
         st.error(error_message)
         logger.error(error_message)
-        all_posts.append({
-            "Instagram ID": username,
-            "Post Count": 0,
-            "Year": "-",
-            "Month": "-",
-            "Links": "User not found"
-        })
+        all_posts.append(error_row(username, "User not found"))
     except Exception as e:
         if client:
             client.handle_exception(client, e)
         st.error(f"Error retrieving posts for {username}: {e}")
-        all_posts.append({
-            "Instagram ID": username,
-            "Post Count": 0,
-            "Year": "-",
-            "Month": "-",
-            "Links": "Error occurred"
-        })
+        all_posts.append(error_row(username, "Error occurred"))
     return all_posts
 
-def save_to_csv(data):
-    df = pd.DataFrame(data)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    csv_filename = f"instagram_results_{timestamp}.csv"
-    df.to_csv(csv_filename, index=False)
+# Each worker thread gets its own client so requests don't share one session object
+_thread_local = threading.local()
+
+def get_worker_client(session_file, fallback_client):
+    client = getattr(_thread_local, "client", None)
+    if client is None:
+        if os.path.exists(session_file):
+            client = Client()
+            load_session(client, session_file)
+            client.handle_exception = fallback_client.handle_exception
+        else:
+            client = fallback_client
+        _thread_local.client = client
+    return client
+
+def process_username(username, start_year, start_month, end_year, end_month, session_file, fallback_client, status_panel):
+    client = get_worker_client(session_file, fallback_client)
+    return manual_search(username, start_year, start_month, end_year, end_month, client, status_panel)
+
+def create_results_csv():
+    """Create a uniquely named temporary results CSV with just the header row."""
+    fd, csv_filename = tempfile.mkstemp(prefix="instagram_results_", suffix=".csv")
+    with os.fdopen(fd, "w", newline="") as file:
+        csv.DictWriter(file, fieldnames=CSV_FIELDS).writeheader()
     return csv_filename
 
 def clean_up_files(file_list):
@@ -213,7 +391,7 @@ if 'client' not in st.session_state or not st.session_state.client:
     if USERNAME and is_session_valid(session_file):
         try:
             st.session_state.client = Client()
-            st.session_state.client.load_settings(session_file)
+            load_session(st.session_state.client, session_file)
             st.sidebar.success(f"Session loaded for {USERNAME}")
             logger.info(f"Session loaded successfully for user: {USERNAME}")
         except Exception as e:
@@ -223,7 +401,7 @@ if 'client' not in st.session_state or not st.session_state.client:
         account = Account(USERNAME, PASSWORD)
         try:
             st.session_state.client = account.get_client()
-            st.session_state.client.dump_settings(session_file)
+            save_session(st.session_state.client, session_file)
             st.sidebar.success(f"Logged in as {USERNAME}")
             logger.info(f"Logged in and saved session for user: {USERNAME}")
         except Exception as e:
@@ -238,21 +416,21 @@ st.header("Input Details")
 # User ID Input Section
 st.subheader("Social Media Handles")
 user_input = st.text_area("Enter Social Media Handles (one per line)")
-instagram_usernames = extract_ig_usernames(user_input)
+instagram_usernames = list(dict.fromkeys(extract_ig_usernames_cached(user_input)))  # Drop duplicates, keep input order
 
 # Date Range Input
 st.subheader("Specify Date Range")
 col1, col2 = st.columns(2)
 with col1:
     start_year = st.number_input("Start Year", min_value=2000, max_value=datetime.now().year, value=datetime.now().year)
-    start_month = st.selectbox("Start Month", [datetime(2000, i, 1).strftime('%B') for i in range(1, 13)], key="start_month")
+    start_month = st.selectbox("Start Month", list(_MONTHS), key="start_month")
 with col2:
     end_year = st.number_input("End Year", min_value=2000, max_value=datetime.now().year, value=datetime.now().year)
-    end_month = st.selectbox("End Month", [datetime(2000, i, 1).strftime('%B') for i in range(1, 13)], key="end_month")
+    end_month = st.selectbox("End Month", list(_MONTHS), key="end_month")
 
 # Convert month names to numbers
-start_month_num = datetime.strptime(start_month, '%B').month
-end_month_num = datetime.strptime(end_month, '%B').month
+start_month_num = _MONTHS[start_month]
+end_month_num = _MONTHS[end_month]
 
 # Check Date Range Validity
 valid_date_range = True
@@ -261,8 +439,9 @@ if (end_year < start_year) or (end_year == start_year and end_month_num < start_
     st.warning("End date cannot be earlier than start date.")
 
 # Initialize results container
-if 'results' not in st.session_state:
-    st.session_state.results = []
+if 'results_csv' not in st.session_state:
+    st.session_state.results_csv = None
+    st.session_state.results_filename = None
 
 # Process All User IDs if valid and client is initialized
 if valid_date_range:
@@ -273,63 +452,84 @@ if valid_date_range:
         elif 'client' not in st.session_state or not st.session_state.client:
             st.warning("Please log in before processing IDs.")
         else:
-            # Clear previous results before processing new ones
-            st.session_state.results = []
+            # Rows stream to a temporary file while processing; it is read back and removed afterwards
+            results_file = create_results_csv()
             progress_bar = st.progress(0)
+            status_panel = StatusPanel()
             total_ids = len(instagram_usernames)
-            processed_usernames = set()  # To avoid duplicate processing
-            for idx, username in enumerate(instagram_usernames):
-                if username not in processed_usernames:
-                    posts_info = manual_search(username, start_year, start_month_num, end_year, end_month_num, st.session_state.client)
-                    st.session_state.results.extend(posts_info)
-                    processed_usernames.add(username)
-                    progress_bar.progress((idx + 1) / total_ids)
-                    st.write(f"Completed processing for {username}.")
+            # Attach the script context so workers can write to the page
+            ctx = get_script_run_ctx()
+            executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, initializer=add_script_run_ctx, initargs=(None, ctx))
+            try:
+                with open(results_file, "a", newline="") as csv_file:
+                    writer = csv.DictWriter(csv_file, fieldnames=CSV_FIELDS)
+                    futures = {}
+                    for username in instagram_usernames:
+                        futures[executor.submit(process_username, username, start_year, start_month_num, end_year, end_month_num, session_file, st.session_state.client, status_panel)] = username
+                    for idx, future in enumerate(as_completed(futures)):
+                        username = futures[future]
+                        try:
+                            posts_info = future.result()
+                        except Exception as e:
+                            # handle_exception re-raises; keep going with the remaining usernames
+                            error_message = f"Error retrieving posts for {username}: {e}"
+                            st.error(error_message)
+                            logger.error(error_message)
+                            posts_info = [error_row(username, "Error occurred")]
+                        writer.writerows(posts_info)
+                        csv_file.flush()
+                        progress_bar.progress((idx + 1) / total_ids)
+                        status_panel.add([f"Completed processing for {username}."])
+            finally:
+                # A widget interaction stops the script mid-loop; drop queued usernames instead of scraping them unseen
+                executor.shutdown(wait=False, cancel_futures=True)
+                with open(results_file, "rb") as file:
+                    st.session_state.results_csv = file.read()
+                st.session_state.results_filename = f"instagram_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+                clean_up_files([results_file])
             st.session_state['process_all'] = True  
 
-# Display results
-results_df = pd.DataFrame(st.session_state.results)
-
 # Utility Functions (make sure to define these properly)
-def generate_csv(results):
-    """Generate and cache the CSV file for download."""
-    df = pd.DataFrame(results)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    csv_filename = f"instagram_results_{timestamp}.csv"
-    df.to_csv(csv_filename, index=False)
-    return csv_filename
-
-def generate_log_file():
-    """Generate and cache the log file for download."""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    log_filename = f"processed_logs_{timestamp}.log"
-    with open(LOG_FILE, "r") as log_file, open(log_filename, "w") as filtered_log_file:
-        for line in log_file:
-            if "Completed" in line or "Error" in line:
-                filtered_log_file.write(line)
-    return log_filename
+@st.cache_data(max_entries=4)
+def load_results(csv_bytes):
+    """Parse the results once per run; returns the last MAX_DISPLAY_ROWS rows and the total row count."""
+    results_df = pd.read_csv(io.BytesIO(csv_bytes), dtype={"Year": str}, keep_default_na=False)
+    return results_df.tail(MAX_DISPLAY_ROWS), len(results_df)
+
+# File mtime/size are part of the cache key, so reruns reuse the bytes until the file changes
+@st.cache_data(max_entries=4)
+def filter_log_file(mtime, size):
+    """Return the Completed/Error lines of the log file as bytes for download."""
+    if shutil.which("grep"):
+        # grep scans a large log far faster than a Python line loop
+        result = subprocess.run(["grep", "-a", "-E", "Completed|Error", LOG_FILE], capture_output=True)
+        # 0 = matches, 1 = no matches; anything higher is a grep error, so fall back to Python
+        if result.returncode <= 1:
+            return result.stdout
+    with open(LOG_FILE, "r") as log_file:
+        return "".join(line for line in log_file if _LOG_FILTER_RE.search(line)).encode()
 
 # Display results
 st.header("Results")
-if 'results' in st.session_state and st.session_state.results:
-    results_df = pd.DataFrame(st.session_state.results)
+if st.session_state.results_csv:
+    results_df, total_rows = load_results(st.session_state.results_csv)
     st.dataframe(results_df)
+    if total_rows > len(results_df):
+        st.caption(f"Showing the last {len(results_df)} of {total_rows} rows. Download the CSV for the full results.")
 
-    # Generate and provide a download button for the results CSV
-    csv_filename = generate_csv(st.session_state.results)
-    with open(csv_filename, "rb") as file:
-        st.download_button("Download CSV", file.read(), csv_filename, "text/csv")
-        os.remove(csv_filename)  # Clean up the file immediately after use
+    # Provide a download button for the streamed results CSV
+    st.download_button("Download CSV", st.session_state.results_csv, st.session_state.results_filename, "text/csv")
 
 # Logging and Downloads
 st.header("Download Logs")
 if os.path.exists(LOG_FILE):
-    log_filename = generate_log_file()
-    with open(log_filename, "rb") as file:
-        st.download_button("Download Log File", file.read(), log_filename, "text/plain")
-        os.remove(log_filename)  # Clean up the log file immediately after use
+    log_stat = os.stat(LOG_FILE)
+    log_bytes = filter_log_file(log_stat.st_mtime, log_stat.st_size)
+    log_filename = f"processed_logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+    st.download_button("Download Log File", log_bytes, log_filename, "text/plain")
 
 # Clean up old session files and processed files
-if is_session_valid(session_file) and (time.time() - os.path.getmtime(session_file)) >= SESSION_DURATION:
+session_file_age = session_age(session_file)
+if session_file_age is not None and session_file_age >= SESSION_DURATION:
     os.remove(session_file)
     logger.info(f"Old session file {session_file} removed.")
@@ -0,0 +1,122 @@
+import importlib
+import re
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def scraper(tmp_path_factory):
+    # Importing runs the Streamlit script in bare mode; keep its log and cache files out of the repo
+    monkeypatch = pytest.MonkeyPatch()
+    monkeypatch.chdir(tmp_path_factory.mktemp("app"))
+    yield importlib.import_module("instagram_scraper")
+    monkeypatch.undo()
+
+
+def legacy_extract_ig_usernames(text):
+    """The original token-by-token parser, kept as the reference behaviour."""
+    usernames = []
+    for line in text.splitlines():
+        for part in line.split():
+            if 'instagram.com' in part:
+                match = re.search(r"instagram\.com/([^/?]+)", part)
+                if match:
+                    usernames.append(match.group(1))
+            elif 'IG:' in part:
+                username = part.split('IG:')[-1].strip().replace('/', '')
+                if username:
+                    usernames.append(username)
+            elif re.match(r'^[\w.]+$', part.strip()):
+                usernames.append(part.strip())
+    return list(filter(None, usernames))
+
+
+@pytest.mark.parametrize("text", [
+    "IG: https://www.instagram.com/foo",
+    "IG: www.instagram.com/foo",
+    "IG:instagram.com/foo",
+    "IG: https://instagr.am/jane",
+    "IG: http://linktr.ee/jane",
+    "instagram.com",
+    "www.instagram.com",
+    "https://www.instagram.com/foo.bar/?hl=en",
+    "IG: baz_1  IG:qux\nIG:quux/",
+    "plain.name\nhello, world  www.instagram.com/zed",
+    "",
+])
+def test_extract_ig_usernames_matches_legacy_parser(scraper, text):
+    assert scraper.extract_ig_usernames(text) == legacy_extract_ig_usernames(text)
+
+
+class FakeMedia:
+    def __init__(self, code, taken_at):
+        self.code = code
+        self.taken_at = taken_at
+
+
+class FakeClient:
+    """Serves pages of one post per day, newest first."""
+
+    def __init__(self, total):
+        now = datetime(2024, 12, 31, tzinfo=timezone.utc)
+        self.medias = [FakeMedia(str(i), now - timedelta(days=i)) for i in range(total)]
+
+    def user_medias_paginated(self, user_id, amount, end_cursor=""):
+        start = int(end_cursor or 0)
+        page = self.medias[start:start + amount]
+        next_cursor = str(start + amount) if start + amount < len(self.medias) else ""
+        return page, next_cursor
+
+    def user_id_from_username(self, username):
+        return "1"
+
+
+class FakeStatusPanel:
+    def add(self, messages):
+        pass
+
+
+@pytest.fixture
+def cache_db(scraper, tmp_path, monkeypatch):
+    path = tmp_path / "cache.db"
+    monkeypatch.setattr(scraper, "CACHE_DB", str(path))
+    # Don't let the shared rate limiters slow the tests down
+    monkeypatch.setattr(scraper, "user_id_bucket", scraper.TokenBucket(1000, 1000))
+    monkeypatch.setattr(scraper, "user_medias_bucket", scraper.TokenBucket(1000, 1000))
+    return path
+
+
+def cached_months(cache_db):
+    with sqlite3.connect(cache_db) as conn:
+        return sorted(conn.execute("SELECT year, month FROM monthly").fetchall())
+
+
+def test_fetch_medias_since_stops_past_start_month(scraper):
+    medias, complete = scraper.fetch_medias_since(FakeClient(365), "1", 2024, 11)
+    assert complete
+    # The second page (posts 50-99) is the first to reach back into October
+    assert len(medias) == 100
+    november = [media for media in medias if (media.taken_at.year, media.taken_at.month) == (2024, 11)]
+    assert len(november) == 30
+
+
+def test_fetch_medias_since_reports_cap(scraper, monkeypatch):
+    monkeypatch.setattr(scraper, "MAX_MEDIAS", 100)
+    medias, complete = scraper.fetch_medias_since(FakeClient(365), "1", 2024, 1)
+    assert not complete
+    assert len(medias) == 100
+
+
+def test_manual_search_caches_every_month_when_fetch_is_complete(scraper, cache_db):
+    rows = scraper.manual_search("jane", 2024, 11, 2024, 12, FakeClient(365), FakeStatusPanel())
+    assert [row["Post Count"] for row in rows] == [30, 31]
+    assert cached_months(cache_db) == [(2024, 11), (2024, 12)]
+
+
+def test_manual_search_caches_only_covered_months_when_capped(scraper, cache_db, monkeypatch):
+    monkeypatch.setattr(scraper, "MAX_MEDIAS", 100)
+    # 100 daily posts reach back to 2024-09-23, so September is partial and earlier months were never fetched
+    scraper.manual_search("jane", 2024, 1, 2024, 12, FakeClient(365), FakeStatusPanel())
+    assert cached_months(cache_db) == [(2024, 10), (2024, 11), (2024, 12)]